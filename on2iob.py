@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
-import collections, copy
-from glob import glob
-import json, os, random
+import collections, contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import json, os, random, re, sys
 
-# use element tree to parse xml
-import xml.etree.ElementTree as ETree
+# use lxml to parse xml, streaming the events with `iterparse`
+from lxml import etree
 
 # use click for command line interface
 import click
@@ -14,125 +14,231 @@ import click
 # tags will be in format [IOB]-{type}, e.g., `B-person`
 I, O, B = 'I', 'O', 'B'
 
-def xml2iob(et_node, data):
-    '''Recursive function for converting an Ontonotes 5 XML file into IOB format.
+# tokens are delimited by spaces, matching them in one pass skips repeated spaces
+TOKEN_RE = re.compile('[^ ]+')
 
-    Args:
-        et_node:  xml.etree.ElementTree.Element
-            An element tree node, generally starting with the root node of the XML document
-            and then recursing on each child node.
-        data:  list(list(tuple(str, str))
-            Sentences of words of tag/token 2-tuples.  This is the IOB data and the outer
-            list will be extended by this function.  Initially, data should start as an
-            empty `[[]]`.
+# number of characters read from each `.name` file at a time while parsing
+CHUNK_SIZE = 1 << 16
+
+# `ENAMEX` tags (whatever that means) in `.name` files surround entity spans
+ENAMEX = 'ENAMEX'
+
+# cache of tag strings keyed by `(tag_pos, tag_type)` so that every occurrence of a
+# tag in the data shares a single string object
+TAG_CACHE = {}
+
+def mktag(tag_pos, tag_type):
+    '''Get the tag string for a position and entity type, e.g., `B-person`.  Tokens
+    outside of an entity, i.e., with an empty `tag_type`, are always tagged as `O`.
     '''
-    def tag_text(text, tag_type):
-        '''Create `list((word, tag))` where the outer list represents sentences, separated
-        by `\n` newlines and the `(word, tag)` 2-tuples are string token-tag pairs.
+    try:
+        return TAG_CACHE[tag_pos, tag_type]
+    except KeyError:
+        tag = sys.intern(tag_pos + '-' + tag_type) if tag_type else O
+        TAG_CACHE[tag_pos, tag_type] = tag
+        return tag
 
+def tag_text(text, tag_type, data):
+    '''Create `list((words, tags))` where the outer list represents sentences, separated
+    by `\n` newlines and `words` and `tags` are parallel lists of string tokens and tags.
+
+    Args:
         text:  str
             The text to tag.  Tokens are separated by whitespace and lines by the `\n`
             newline character.
         tag_type: str
             The entity type for the tag, e.g., `person`.  The `IOB` part will be determined
             by the sequence of tokens in the text.
-        '''
-        lines = text.split('\n')
-        nlines = len(lines)
-
-        # for each line in the text
-        for i, line in enumerate(lines):
-            # start with the begin position
-            tag_pos = B
-
-            # remove leading and trailing whitespace
-            line = line.strip(' ')
-
-            # for each whitespace delimited token
-            for word in line.split(' '):
-                # skip empty tokens and repeated spaces
-                if not word: continue
-
-                # build the tag from position and type
-                tag = tag_pos + '-' + tag_type if tag_type else O
-
-                # append to the sentence
-                data[-1].append((word, tag))
-
-                # remaining tokens are inside
-                tag_pos = I
-
-            # split off new sentence
-            if i < nlines - 1:
-                data.append([])
-
-    # Main text of the node, not inside subtags.  Note that a node may not have text,
-    # e.g., for the root `<DOC>` tag if the first word is an entity.
-    # For entity, `ENAMEX` tags, this will contain the entity tokens.
-    if et_node.text:
-        # `ENAMEX` tags (whatever that manes) in `.name` files surround entity spans.
-        # The `TYPE` attribute contains the type of the entity.
-        tag_type = et_node.attrib['TYPE'].lower() if et_node.tag == 'ENAMEX' else ''
-        tag_text(et_node.text, tag_type)
-
-    # Recurse, depth first, over each child.
-    for et_child in et_node:
-        xml2iob(et_child, data)
-
-    # The tail is the text *after* the tag.  Since we don't support nested `ENAMEX` tags,
-    # we just assume this is outside of any entity and is tagged as `O`.
-    if et_node.tail:
-        tag_text(et_node.tail, '')
-
-def parse_iob_files(filenames, verbose):
-    '''Convert a list of `.name` files into iob format.
+        data:  list(tuple(list(str), list(str)))
+            Sentences of parallel word and tag lists.  The tagged tokens are appended to the
+            last sentence and a new sentence is started for each newline.
     '''
-    iob_data = []
-    for filename in filenames:
-        if verbose:
-            print(filename, '- ', end='')
+    lines = text.split('\n')
+    nlines = len(lines)
 
-        # open the current file for reading, UTF8 or bust!
-        with open(filename, mode='rt', encoding='utf8') as fh:
-            raw_data = fh.read()
+    # look up the shared tags once rather than for each token
+    begin_tag, inside_tag = mktag(B, tag_type), mktag(I, tag_type)
 
-        # get the root node from the string file contents
-        et_root = ETree.fromstring(raw_data)
+    # for each line in the text
+    for i, line in enumerate(lines):
+        # whitespace delimited tokens, which are interned when added to the sentence since
+        # a few common words make up a large share of the tokens
+        words = TOKEN_RE.findall(line)
 
-        # the IOB data for this file is extracted recursively
-        local_iob_data = [[]] # this is what's built up
-        xml2iob(et_root, local_iob_data)
+        # the first token begins the entity and the remaining tokens are inside
+        if words:
+            sent_words, sent_tags = data[-1]
+            sent_words.extend(map(sys.intern, words))
+            sent_tags.append(begin_tag)
+            sent_tags.extend([inside_tag] * (len(words) - 1))
 
-        # filter any empties
-        # FIXME: why is this necessary?
-        local_iob_data = list(filter(lambda sent: sent, local_iob_data))
+        # split off new sentence
+        if i < nlines - 1:
+            data.append(([], []))
+
+def xml2iob(filename, data):
+    '''Convert an Ontonotes 5 XML file into IOB format.
+
+    The file is read in chunks and fed to an `lxml.etree.XMLPullParser` rather than
+    loaded into a full element tree.  Elements are cleared once their text has been
+    consumed so that memory use stays proportional to the depth of the document rather
+    than its length.
+
+    Args:
+        filename:  str
+            Path to the `.name` XML file to parse.
+        data:  list(tuple(list(str), list(str)))
+            Sentences of parallel word and tag lists.  This is the IOB data and the outer
+            list will be extended by this function.  Initially, data should start as an
+            empty `[([], [])]`.
+
+    Returns:
+        int
+            The number of non-blank lines in the raw file.  This is counted from the text
+            as it is read, independently of the parser, so that it can be used to verify
+            that no text was lost.
+    '''
+    # Stack of entity types for the currently open elements.  The `TYPE` attribute of
+    # `ENAMEX` tags contains the type of the entity.  Other tags, e.g., the root `<DOC>`,
+    # are outside of any entity.
+    tag_types = []
+    push_type, pop_type = tag_types.append, tag_types.pop
+
+    # Comments and processing instructions are dropped, as with `xml.etree`, so that
+    # they are never mistaken for the first child of an element.
+    parser = etree.XMLPullParser(events=('start', 'end'), base_url=filename,
+                                 remove_comments=True, remove_pis=True)
+
+    # number of non-blank lines read so far and whether the current, possibly
+    # incomplete, line has anything other than whitespace
+    nlines, line_nonblank = 0, False
+
+    # open the current file for reading, UTF8 or bust!
+    with open(filename, mode='rt', encoding='utf8') as fh:
+        while True:
+            chunk = fh.read(CHUNK_SIZE)
+            if chunk:
+                parser.feed(chunk)
+
+                # the first piece continues the current line and the last piece starts
+                # a new one, anything in between is a complete line
+                lines = chunk.split('\n')
+                line_nonblank = line_nonblank or bool(lines[0].strip())
+                if len(lines) > 1:
+                    nlines += line_nonblank + sum(1 for line in lines[1:-1] if line.strip())
+                    line_nonblank = bool(lines[-1].strip())
+            else:
+                # raises if the document is incomplete
+                parser.close()
+                nlines += line_nonblank
+
+            # Note that the text and tail of an element are not guaranteed to be complete
+            # when its `start` event is received, only once the parser has moved past
+            # them.  So, the text of an element is emitted at the start of its first child
+            # or, if it has no children, at its own end.  The tail of an element is
+            # emitted at the start of its next sibling or at the end of its parent.
+            for event, et_node in parser.read_events():
+                if event == 'start':
+                    et_prev = et_node.getprevious()
+                    if et_prev is not None:
+                        # The tail is the text *after* the tag.  Since we don't support
+                        # nested `ENAMEX` tags, we just assume this is outside of any
+                        # entity.
+                        if et_prev.tail:
+                            tag_text(et_prev.tail, '', data)
+
+                        # free the siblings that have been fully consumed
+                        et_parent = et_node.getparent()
+                        while et_node.getprevious() is not None:
+                            del et_parent[0]
+
+                    elif tag_types:
+                        # Main text of the parent, not inside subtags.  Note that a node
+                        # may not have text, e.g., for the root `<DOC>` tag if the first
+                        # word is an entity.
+                        et_parent = et_node.getparent()
+                        if et_parent.text:
+                            tag_text(et_parent.text, tag_types[-1], data)
+
+                    push_type(
+                        et_node.get('TYPE', '').lower() if et_node.tag == ENAMEX else '')
+
+                else:
+                    tag_type = pop_type()
+
+                    if len(et_node):
+                        # the tail of the last child is now complete
+                        if et_node[-1].tail:
+                            tag_text(et_node[-1].tail, '', data)
+
+                    elif et_node.text:
+                        # for entity, `ENAMEX` tags, this will contain the entity tokens
+                        tag_text(et_node.text, tag_type, data)
+
+                    # keep the tail until the next sibling or the end of the parent
+                    et_node.clear(keep_tail=True)
+
+            if not chunk:
+                return nlines
+
+def parse_iob_file(filename):
+    '''Convert a single `.name` file into iob format.
+    '''
+    # the IOB data for this file is extracted by streaming the xml
+    local_iob_data = [([], [])] # this is what's built up
+    nraw_lines = xml2iob(filename, local_iob_data)
 
-        # verify that the number of sentences matches the number of lines in the document
-        # this appears to be how the `.name` files are structured.
-        nsent = len(local_iob_data)
-        nraw_sent = len(list(filter(lambda line: line.strip(), raw_data.split('\n')))) - 2
-        if nsent != nraw_sent:
-            raise RuntimeError(
-                f'Parsed sentences `{nsent}` does not match number of lines `{nraw_sent}` in `{filename}`')
+    # filter any empties
+    # FIXME: why is this necessary?
+    local_iob_data = [sent for sent in local_iob_data if sent[0]]
 
-        # append to the full IOB data
-        iob_data.extend(local_iob_data)
+    # verify that the number of sentences matches the number of lines in the document
+    # this appears to be how the `.name` files are structured.
+    nsent = len(local_iob_data)
+    nraw_sent = nraw_lines - 2
+    if nsent != nraw_sent:
+        raise RuntimeError(
+            f'Parsed sentences `{nsent}` does not match number of lines `{nraw_sent}` in `{filename}`')
 
-        if verbose:
-            print(nsent)
+    return local_iob_data
+
+def parse_iob_files(filenames, verbose, jobs=None):
+    '''Convert a list of `.name` files into iob format.
+
+    Each file is independent, so they are parsed in parallel across `jobs` worker
+    processes, defaulting to the number of CPUs.  The results are gathered in the
+    order of `filenames`.  With `jobs=1` the files are parsed serially in this process.
+    '''
+    iob_data = []
+    with contextlib.ExitStack() as stack:
+        if jobs == 1:
+            results = map(parse_iob_file, filenames)
+        else:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=jobs))
+            results = executor.map(parse_iob_file, filenames, chunksize=16)
+
+        for filename, local_iob_data in zip(filenames, results):
+            # append to the full IOB data
+            iob_data.extend(local_iob_data)
+
+            if verbose:
+                print(filename, '-', len(local_iob_data))
 
     return iob_data
 
 def write_iob(filename, data):
     '''Write IOB sentence data to file.
     '''
-    nsent = len(data)
+    assert all(words for words, tags in data)
+
+    # build the whole file in memory and write it at once, sentences are separated
+    # by a blank line and every line, including the last, ends with a newline
+    body = '\n\n'.join('\n'.join(map(' '.join, zip(words, tags))) for words, tags in data)
+
     with open(filename, mode='wt', encoding='utf8') as fh:
-        for i, sent in enumerate(data):
-            assert sent
-            fh.writelines([' '.join(token_tag) + '\n' for token_tag in sent])
-            if i < nsent - 1:
-                fh.write('\n')
+        if body:
+            fh.write(body)
+            fh.write('\n')
 
 def build_random_partitions(iob_data, valid_frac=0.07, test_frac=0.07, seed=42):
     '''Random train/validation/test split with seeded number generator.
@@ -143,41 +249,43 @@ def build_random_partitions(iob_data, valid_frac=0.07, test_frac=0.07, seed=42):
     # FIXME: make another function to do this in the standard way
     rng = random.Random(seed)
 
-    # copy the data to prevent shuffling as a side-effect
-    iob_data = copy.deepcopy(iob_data)
-
-    # shuffle the sentences
-    rng.shuffle(iob_data)
-
+    # shuffle the sentence indices rather than the sentences themselves, which avoids
+    # copying the data to prevent shuffling as a side-effect
     nsent = len(iob_data)
+    idx = list(range(nsent))
+    rng.shuffle(idx)
+
     valid_end = int(valid_frac * nsent)
     test_end = valid_end + int(test_frac * nsent)
 
-    train_data = iob_data[:valid_end]
-    valid_data = iob_data[valid_end:test_end]
-    test_data = iob_data[test_end:]
+    # gather each partition straight from the shuffled indices, these only hold
+    # references to the sentences in `iob_data`
+    valid_data = [iob_data[i] for i in idx[:valid_end]]
+    test_data = [iob_data[i] for i in idx[valid_end:test_end]]
+    train_data = [iob_data[i] for i in idx[test_end:]]
 
     return train_data, valid_data, test_data
 
 def print_metrics(iob_data):
     '''Print some useful metrics about the data to the console.
     '''
+    # gather everything in a single pass over the data, counting each distinct label
+    # with `Counter.update` so that the per-token work stays in C
+    ntok = 0
+    label_counts = collections.Counter()
+    for words, tags in iob_data:
+        ntok += len(words)
+        label_counts.update(tags)
+
     print('=======')
     print('total sentences:', len(iob_data))
-    print('total tokens:', sum(len(sent) for sent in iob_data))
+    print('total tokens:', ntok)
 
-    labels = sorted(set(label for sent in iob_data for word, label in sent))
+    labels = sorted(label_counts)
     print('total labels:', len(labels), '-', labels)
 
-    tag_counts = collections.defaultdict(int)
-    for sent in iob_data:
-        for word, tag in sent:
-            if tag is O:
-                continue
-
-            tag_pos, tag_type = tag.split('-')
-            if tag_pos == B:
-                tag_counts[tag_type] += 1
+    # count the entities by the type of their begin tags, e.g., `B-person`
+    tag_counts = {label[2:]: count for label, count in label_counts.items() if label[0] == B}
 
     tag_counts = sorted(tag_counts.items(), key=lambda pair: pair[1], reverse=True)
 
@@ -190,28 +298,43 @@ def print_metrics(iob_data):
 @click.option('--train-file', 'trainfile', default='train.txt', help='Name of the output training data file in IOB format.')
 @click.option('--valid-file', 'validfile', default='valid.txt', help='Name of the output validation data file in IOB format.')
 @click.option('--test-file', 'testfile', default='test.txt', help='Name of the output test data file in IOB format.')
+@click.option('-j', '--jobs', 'jobs', default=os.cpu_count(), type=click.IntRange(min=1), help='Number of worker processes used to parse the `.name` files.')
 @click.option('-v', '--verbose', 'verbose', is_flag=True, default=True, help='Print verbose information to the console.')
-def main(data_dir, iobfile, trainfile, validfile, testfile, verbose):
+def main(data_dir, iobfile, trainfile, validfile, testfile, jobs, verbose):
     # path containing subdirectories with the `.name` annotation XML files
     # these are provided with the Ontonotes 5 dataset, which must be acquired from the LDC
     datadir = os.path.realpath(os.path.expanduser(data_dir))
 
-    # recursively glob all the file names
-    filenames = sorted(glob(os.path.join(datadir, '**/*.name'), recursive=True))
+    # recursively walk the directory tree for all the file names, skipping hidden files
+    # and directories, e.g., `._*` resource forks left by macOS, like `glob` does
+    filenames = []
+    for dirpath, dirnames, dirfilenames in os.walk(datadir, followlinks=True):
+        dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+        filenames.extend(os.path.join(dirpath, filename) for filename in dirfilenames
+                         if filename.endswith('.name') and not filename.startswith('.'))
+    filenames.sort()
 
     # parse the files
-    iob_data = parse_iob_files(filenames, verbose)
+    iob_data = parse_iob_files(filenames, verbose, jobs)
     if verbose:
         print_metrics(iob_data)
 
-    # write the full data to `iob.txt`
-    write_iob(iobfile, iob_data)
-
-    # build and write the train, valid and test partitions
+    # build the train, valid and test partitions
     train_data, valid_data, test_data = build_random_partitions(iob_data)
-    write_iob(validfile, train_data)
-    write_iob(testfile, valid_data)
-    write_iob(trainfile, test_data)
+
+    # write the full data to `iob.txt` along with the partitions, the files are
+    # independent so the writes are overlapped in threads
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(write_iob, iobfile, iob_data),
+            executor.submit(write_iob, trainfile, train_data),
+            executor.submit(write_iob, validfile, valid_data),
+            executor.submit(write_iob, testfile, test_data),
+        ]
+
+    # raise any errors from the writes
+    for future in futures:
+        future.result()
 
 if __name__ == '__main__':
     main()